@@ -1,12 +1,21 @@
+import boto3
+from boto3.s3.transfer import TransferConfig
 import gspread as gs
+from gspread.utils import absolute_range_name
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 import psycopg2
 from os import environ, getenv
 from dotenv import load_dotenv
 import logging as log
-from datetime import datetime
+from time import monotonic
 from sys import exit
-from ast import literal_eval
+import json
+import csv
+from functools import lru_cache
+from io import BytesIO, StringIO, TextIOBase
+from urllib.parse import urlparse
 
 
 # ENVs
@@ -14,6 +23,10 @@ load_dotenv()
 
 PIPELINE_NAME = getenv('PIPELINE_NAME', 'UNNAMED')
 PIPELINE_LOG_LEVEL = getenv('PIPELINE_LOG_LEVEL', 'info')
+# How the data is loaded: `s3` - Parquet files in S3 + COPY, `stdin` - COPY ... FROM STDIN (PostgreSQL only)
+PIPELINE_LOAD_MODE = getenv('PIPELINE_LOAD_MODE', 's3')
+# Format of the `=GOOGLEFINANCE(...)` date column. Depends on the spreadsheet's locale
+PIPELINE_GOOGLE_SHEET_DATE_FORMAT = getenv('PIPELINE_GOOGLE_SHEET_DATE_FORMAT', '%m/%d/%Y %H:%M:%S')
 
 LOG_LEVELS = {
     'CRITICAL': 50,
@@ -24,37 +37,111 @@ LOG_LEVELS = {
     'NOTSET': 0
 }
 
+# Name of the file every worksheet is written to, under PIPELINE_AWS_S3_URI directory
+S3_FILENAME = 'currency_exchange_rates.parquet'
+# multipart upload settings used when streaming files to S3
+S3_TRANSFER_CONFIG = TransferConfig(multipart_chunksize=8 * 1024 * 1024, max_concurrency=8)
+
+# Clients kept across warm AWS Lambda invocations.
+# Redshift connection is deliberately not cached, an idle session may be dropped between scheduled runs
+_GS_CLIENT = None
+_GS_CREDENTIALS = None
+_S3_CLIENT = None
+_S3_CREDENTIALS = None
+
+
+@lru_cache(maxsize=1)
+def load_service_account(service_account: str) -> dict:
+    """Parses google service account credentials, once per distinct value
+
+    Args:
+        service_account (str): JSON contents of the service_account.json file
+
+    Returns:
+        dict: Google service account credentials
+    """
+    return json.loads(service_account)
+
+
+def get_google_client(google_service_account_credentials: dict) -> gs.Client:
+    """Returns google sheets client, reusing the previous one when credentials haven't changed
+
+    Args:
+        google_service_account_credentials (dict): Google service account credentials
+
+    Returns:
+        gs.Client: Authorized google sheets client
+    """
+    global _GS_CLIENT, _GS_CREDENTIALS
+    if _GS_CLIENT is None or _GS_CREDENTIALS != google_service_account_credentials:
+        _GS_CLIENT = gs.service_account_from_dict(google_service_account_credentials)
+        _GS_CREDENTIALS = google_service_account_credentials
+    return _GS_CLIENT
+
+
+def get_s3_client(s3_key: str, s3_secret: str):
+    """Returns AWS S3 client, reusing the previous one when credentials haven't changed
+
+    Args:
+        s3_key (str): AWS S3 access key
+        s3_secret (str): AWS S3 access secret
+
+    Returns:
+        botocore.client.S3: AWS S3 client
+    """
+    global _S3_CLIENT, _S3_CREDENTIALS
+    if _S3_CLIENT is None or _S3_CREDENTIALS != (s3_key, s3_secret):
+        _S3_CLIENT = boto3.client('s3', aws_access_key_id=s3_key, aws_secret_access_key=s3_secret)
+        _S3_CREDENTIALS = (s3_key, s3_secret)
+    return _S3_CLIENT
+
 
 def stream_dataframe_to_s3(
         df: pd.DataFrame,
         s3_uri: str,
-        s3_key: str,
-        s3_secret: str) -> None:
-    """Uploads pandas dataframe to a CSV file specified by the S3 URI
+        s3_client) -> None:
+    """Uploads pandas dataframe to a Snappy compressed Parquet file specified by the S3 URI
 
     Args:
-        df (pd.DataFrame): Pandas dataframe with data to be written to the CSV
-        s3_uri (str): AWS S3 file key for the CSV file
-        s3_key (str): AWS S3 access key
-        s3_secret (str): AWS S3 access secret
+        df (pd.DataFrame): Pandas dataframe with data to be written to the Parquet file
+        s3_uri (str): AWS S3 file key for the Parquet file
+        s3_client (botocore.client.S3): AWS S3 client
     """
     try:
-        log.debug(f'Uploading the data to "{s3_uri}"')
-        s3_start = datetime.now()
-        # stream the dataframe to s3 bucket
-        df.to_csv(f'{s3_uri}', index=False, storage_options={"key": s3_key, "secret": s3_secret})
-        log.info(f'Data has been uploaded to `{s3_uri}`. Time taken {datetime.now() - s3_start}')
+        log.debug('Uploading the data to "%s"', s3_uri)
+        s3_start = monotonic()
+        url = urlparse(s3_uri)
+        buffer = BytesIO()
+        df.to_parquet(buffer, engine='pyarrow', compression='snappy', index=False)
+        buffer.seek(0)
+        # stream the Parquet file to s3 bucket
+        s3_client.upload_fileobj(buffer, url.netloc, url.path.lstrip('/'), Config=S3_TRANSFER_CONFIG)
+        log.info(f'Data has been uploaded to `{s3_uri}`. Time taken {monotonic() - s3_start:.3f} seconds')
     except Exception as e:
-        log.exception(f'CSV file upload to AWS S3 has failed. Time taken {datetime.now() - s3_start}')
+        log.exception(f'Parquet file upload to AWS S3 has failed. Time taken {monotonic() - s3_start:.3f} seconds')
         exit(1)
 
 
-def google_sheet_to_s3(
+def worksheet_to_df(
+        currency_labels: list[str],
+        values: list[list]) -> pd.DataFrame:
+    """Load a single worksheet's values into a pandas dataframe and clean up its data.
+
+    Args:
+        currency_labels (list[str]): List of two names - [0] Currency from, [1] Currency to
+        values (list[list]): Worksheet cell values, first row being the header
+
+    Returns:
+        pd.DataFrame: Post data cleanse worksheet dataframe
+    """
+    # load worksheet values into pandas df, column names must be lowercase
+    df = pd.DataFrame(values[1:], columns=[col.lower() for col in values[0]])
+    return currency_exchange_sheet_post_processing(df, currency_labels)
+
+
+def google_sheet_to_df(
         google_sheet_id: str,
-        google_service_account_credentials: dict,
-        s3_uri: str,
-        s3_key: str,
-        s3_secret: str) -> pd.DataFrame:
+        google_service_account_credentials: dict) -> pd.DataFrame:
     """Read google sheet data and load every worksheet into a single pandas dataframe.
 
     WARNING: To be used with spreadsheets with all worksheets consisting only with `=GOOGLEFINANCE(...)` data!
@@ -64,116 +151,200 @@ def google_sheet_to_s3(
         google_service_account_credentials (dict): TODO
 
     Returns:
-        pd.DataFrame: Pandas dataframe containing data from every worksheet in read google sheet
+        pd.DataFrame: Pandas dataframe containing data from every worksheet in read google sheet.
+            Empty when there is no worksheet with a valid name
     """
-    log.debug(f'Connecting to google sheet with id "{google_sheet_id}"')
-    log.debug(f'Google API credentials file used "{google_service_account_credentials}"')
+    log.debug('Connecting to google sheet with id "%s"', google_sheet_id)
+    log.debug('Google API credentials file used "%s"', google_service_account_credentials)
     try:
-        gs_start = datetime.now()
-        gc = gs.service_account_from_dict(google_service_account_credentials)
+        gs_start = monotonic()
+        gc = get_google_client(google_service_account_credentials)
         sh = gc.open_by_key(google_sheet_id)
-        log.info(f'Done reading google sheet. Time taken {datetime.now() - gs_start}')
+        worksheets = []
+        currency_labels = []
+        for worksheet in sh.worksheets():
+            # get the currency from, to labels from worksheet name
+            currency_from, _, currency_to = worksheet.title.partition('2')
+            if not currency_from or not currency_to:
+                log.warning('Skipping worksheet with name "%s". Name must be <currency_from>2<currency_to>', worksheet.title)
+                continue
+            worksheets.append(worksheet)
+            currency_labels.append([currency_from, currency_to])
+        if not worksheets:
+            log.warning('No worksheet with a valid name found in google sheet with id "%s"', google_sheet_id)
+            return pd.DataFrame()
+        # read every worksheet with a single batch request
+        # numbers come back unformatted (full precision, no string parsing), dates as formatted strings
+        value_ranges = sh.values_batch_get(
+            [absolute_range_name(worksheet.title) for worksheet in worksheets],
+            params={'valueRenderOption': 'UNFORMATTED_VALUE', 'dateTimeRenderOption': 'FORMATTED_STRING'}
+        )['valueRanges']
+        log.info(f'Done reading google sheet. Time taken {monotonic() - gs_start:.3f} seconds')
     except Exception as e:
-        log.exception(f'Failed to read google sheet with id "{google_sheet_id}". Time taken {datetime.now() - gs_start}')
+        log.exception(f'Failed to read google sheet with id "{google_sheet_id}". Time taken {monotonic() - gs_start:.3f} seconds')
         exit(1)
-    for worksheet in sh.worksheets():
-        wh_start = datetime.now()
-        log.debug(f'Processing worksheet with name "{worksheet.title}"')
+    # checked once, spares building the per worksheet timing messages when DEBUG is off
+    debug = log.getLogger().isEnabledFor(log.DEBUG)
+    frames = []
+    for worksheet, labels, value_range in zip(worksheets, currency_labels, value_ranges):
+        wh_start = monotonic()
+        log.debug('Processing worksheet with name "%s"', worksheet.title)
         try:
-            # read worksheet by id into pandas df
-            ws = sh.get_worksheet_by_id(worksheet.id)
-            df = pd.DataFrame(ws.get_all_records())
-            # get the currency from, to labels from worksheet name
-            currency_labels = worksheet.title.split('2')
-            s3_filename = f'{currency_labels[0]}_{currency_labels[1]}.csv'
-            df = currency_exchange_sheet_post_processing(df, currency_labels)
-            # Strem the CSV to S3 bucket
-            stream_dataframe_to_s3(
-                df,
-                s3_uri + s3_filename,
-                s3_key,
-                s3_secret
-            )
-            log.debug(f'Processing worksheet with name "{worksheet.title}". Time taken {datetime.now() - wh_start}')
+            frames.append(worksheet_to_df(labels, value_range.get('values', [[]])))
+            if debug:
+                log.debug('Processing worksheet with name "%s". Time taken %.3f seconds', worksheet.title, monotonic() - wh_start)
         except Exception as e:
-            log.exception(f'Failed processing worksheet with name "{worksheet.title}". Time taken {datetime.now() - wh_start}')
+            log.exception(f'Failed processing worksheet with name "{worksheet.title}". Time taken {monotonic() - wh_start:.3f} seconds')
             exit(1)
-    log.info(f'Done processing google sheet. Time taken {datetime.now() - gs_start}"')
+    log.info(f'Done processing google sheet. Time taken {monotonic() - gs_start:.3f} seconds"')
+    # single concat, growing the dataframe worksheet by worksheet would copy it over and over
+    df = pd.concat(frames, ignore_index=True, copy=False)
+    # concat of categoricals with different categories falls back to object, merge them instead
+    for col in ('currency_from', 'currency_to'):
+        df[col] = union_categoricals([frame[col] for frame in frames])
+    return df
+
+
+class CsvRowsReader(TextIOBase):
+    """Read-only file-like object serializing rows to CSV lazily, as they are read.
+    Only the rows needed for the current read are held as CSV text, so memory stays
+    flat regardless of the number of rows.
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        # serialize rows until there is enough CSV text for this read
+        while size < 0 or self._buffer.tell() < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._writer.writerow(row)
+        data = self._buffer.getvalue()
+        if size < 0:
+            size = len(data)
+        # keep the unread remainder for the next read
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._buffer.write(data[size:])
+        return data[:size]
+
+
+def copy_dataframe_from_stdin(cur, table: str, df: pd.DataFrame) -> int:
+    """Runs COPY {table} (date, currency_from, currency_to, close) FROM STDIN WITH CSV,
+    streaming the dataframe as CSV through the connection itself.
+
+    NOTE: AWS Redshift does not support COPY ... FROM STDIN, this is meant for
+    PostgreSQL targets, e.g. local development runs.
+
+    Args:
+        cur (psycopg2.extensions.cursor): Open cursor
+        table (str): Table to copy the data into
+        df (pd.DataFrame): Pandas dataframe with the data to be copied
+
+    Returns:
+        int: Number of copied rows
+    """
+    # missing values must be empty fields for COPY to read them as NULL
+    rows = (
+        tuple(None if pd.isna(value) else value for value in row)
+        for row in df.itertuples(index=False, name=None)
+    )
+    cur.copy_expert(
+        f"COPY {table} (date, currency_from, currency_to, close) FROM STDIN WITH CSV",
+        CsvRowsReader(rows)
+    )
+    return cur.rowcount
 
 
-def load_csv_into_redshift(
+def load_into_redshift(
         redshift_dsn: str,
         redshift_table: str,
-        s3_uri: str,
-        s3_key: str,
-        s3_secret: str) -> None:
-    """Runs
-
-    COPY {redshift_table} (date, currency_from, currency_to, close)
+        s3_uri: str = None,
+        s3_key: str = None,
+        s3_secret: str = None,
+        df: pd.DataFrame = None) -> None:
+    """Loads a session scoped temporary stage table and upserts it into the target table.
+    Stage table is loaded by running
+
+    COPY {stage_table}
         FROM '{s3_uri}'
         CREDENTIALS 'aws_access_key_id={s3_key};aws_secret_access_key={s3_secret}'
-        IGNOREHEADER 1
-        DELIMITER ','
+        FORMAT AS PARQUET
+
+    or, when `df` is given, by streaming it with COPY ... FROM STDIN (see `copy_dataframe_from_stdin`)
 
     Args:
         redshift_dsn (str): AWS Redshift connection DSN
         redshift_table (str): AWS Redshift target table
-        s3_uri (str): AWS S3 directory URI
+        s3_uri (str): AWS S3 Parquet file URI
         s3_key (str): AWS S3 access key
         s3_secret (str): AWS S3 access secret
+        df (pd.DataFrame): Pandas dataframe to be loaded instead of the S3 file
     """
-    rs_start = datetime.now()
+    rs_start = monotonic()
+    conn = None
     try:
         log.debug('Connecting to AWS Redshift')
         conn = psycopg2.connect(redshift_dsn)
-        # Truncates the stage table
-        # TODO: We should assume there is no stage table for this job!
-        truncate_command = f"TRUNCATE {redshift_table}_stage"
+        # every statement below runs in a single transaction, committed once at the end
+        conn.set_session(autocommit=False)
+        # Creates the stage table, private to this session so concurrent runs can't clash
+        stage_table = f"{redshift_table.split('.')[-1]}_stage"
+        create_command = f"CREATE TEMP TABLE {stage_table} (LIKE {redshift_table})"
         # Loads data in stage table
-        # TODO: We should assume there is no stage table for this job!
+        # Parquet columns are mapped by position: date, currency_from, currency_to, close
         copy_command = f"""
-        COPY {redshift_table}_stage (date, currency_from, currency_to, close)
+        COPY {stage_table}
             FROM '{s3_uri}'
             CREDENTIALS 'aws_access_key_id={s3_key};aws_secret_access_key={s3_secret}'
-            IGNOREHEADER 1
-            DELIMITER ','
+            FORMAT AS PARQUET
         """
-        # Move data from stage to target table
+        # Move missing data from stage to target table
+        # NOTE: Redshift's MERGE requires a WHEN MATCHED clause, which would rewrite every existing row
         # TODO: Should be removed. This should be left to a dbt job!
         upsert_command = f"""
         INSERT INTO {redshift_table}
         SELECT
             stage.*
-        FROM {redshift_table} target
-            RIGHT JOIN {redshift_table}_stage stage USING (date, currency_from, currency_to)
+        FROM {stage_table} stage
+            LEFT JOIN {redshift_table} target USING (date, currency_from, currency_to)
         WHERE target.date IS NULL
         """
-        with conn:
-            with conn.cursor() as cur:
-                log.debug('Truncating AWS Redshift stage table')
-                cur.execute(truncate_command)
-                log.debug('Truncating AWS Redshift stage table has been successful')
-
-            with conn.cursor() as cur:
-                log.debug('Loading data into AWS Redshift')
+        with conn, conn.cursor() as cur:
+            log.debug('Creating AWS Redshift stage table')
+            cur.execute(create_command)
+            log.debug('Creating AWS Redshift stage table has been successful')
+
+            log.debug('Loading data into AWS Redshift')
+            if df is None:
                 cur.execute(copy_command)
                 # get number of inserted records
                 cur.execute("SELECT pg_last_copy_count()")
-                log.debug('Loading data into AWS Redshift has been successful. Affected rows: {}'.format(cur.fetchone()[0]))
+                copied_rows = cur.fetchone()[0]
+            else:
+                copied_rows = copy_dataframe_from_stdin(cur, stage_table, df)
+            log.debug('Loading data into AWS Redshift has been successful. Affected rows: %s', copied_rows)
 
             # TODO: Should be done by dbt!
-            with conn.cursor() as cur:
-                log.debug('Running upsert on target table')
-                cur.execute(upsert_command)
-                log.debug(f'Running upsert on target table has been successful. Affected rows: {cur.rowcount}')
-        log.info(f'Successully run data refresh on AWS Redshift. Time taken {datetime.now() - rs_start}')
+            log.debug('Running upsert on target table')
+            cur.execute(upsert_command)
+            log.debug('Running upsert on target table has been successful. Affected rows: %s', cur.rowcount)
+        log.info(f'Successully run data refresh on AWS Redshift. Time taken {monotonic() - rs_start:.3f} seconds')
     except Exception as e:
         log.exception(
-            f'Failed running COPY ... CSV ... on AWS Redshift. Time taken {datetime.now() - rs_start}'
+            f'Failed running COPY ... on AWS Redshift. Time taken {monotonic() - rs_start:.3f} seconds'
         )
 
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
 
 
 # Only applicable to currency exchange spreadsheet
@@ -189,15 +360,24 @@ def currency_exchange_sheet_post_processing(
     Returns:
         pd.DataFrame: Post data cleanse worksheet dataframe
     """
-    # column names must be lowercase
-    df.columns = [col.lower() for col in df.columns]
-    # convert datetime string to datetime dtype
-    df['date'] = pd.to_datetime(df['date']).dt.date
-    # add the labels
-    df = add_currency_labels(df, currency_labels[0], currency_labels[1])
-    # currency names must be uppercase
-    df['currency_from'] = df['currency_from'].str.upper()
-    df['currency_to'] = df['currency_to'].str.upper()
+    # convert datetime string to datetime dtype, truncated to the day
+    df['date'] = pd.to_datetime(
+        df['date'], format=PIPELINE_GOOGLE_SHEET_DATE_FORMAT, errors='raise', cache=True
+    ).dt.normalize()
+    # Parquet is typed and COPY is positional, close must be float64 to land in the FLOAT column,
+    # even when every value in the worksheet is an integer.
+    # Kept as float64, float32 would round the rates to ~7 significant digits
+    close = pd.to_numeric(df['close'], errors='coerce').astype('float64')
+    # non-numeric cells, e.g. `#N/A`, are loaded as NULL instead of failing the whole run
+    invalid = close.isna() & df['close'].notna()
+    if invalid.any():
+        log.warning(
+            'Worksheet "%s2%s" has %d non-numeric close value(s), loading them as NULL',
+            currency_labels[0], currency_labels[1], invalid.sum()
+        )
+    df['close'] = close
+    # add the labels, currency names must be uppercase
+    df = add_currency_labels(df, currency_labels[0].upper(), currency_labels[1].upper())
 
     return df
 
@@ -215,23 +395,24 @@ def add_currency_labels(df: pd.DataFrame, from_value: str, to_value: str) -> pd.
     Returns:
         pd.DataFrame: [description]
     """
-    # append currency labels
-    df['currency_from'] = from_value
-    df['currency_to'] = to_value
+    # append currency labels as single category columns, one int8 code per row
+    codes = np.zeros(len(df), dtype=np.int8)
+    df['currency_from'] = pd.Categorical.from_codes(codes, categories=[from_value])
+    df['currency_to'] = pd.Categorical.from_codes(codes, categories=[to_value])
     return df[['date', 'currency_from', 'currency_to', 'close']]
 
 
 def pipeline():
     """Pipeline execution
 
-    - Google sheet's worksheets to CSVs in S3 bucket
+    - Google sheet's worksheets to single pandas dataframe
         - Retrieves data from specified spreadsheet (env. variable)
-        - Iterates over every worksheet and cleans up the data
-        - Uploads each worksheet to single CSV file on AWS S3 bucket (env. variables). Worksheet name must be <currency_from>2<currency_to>
+        - Iterates over every worksheet and cleans up the data. Worksheet name must be <currency_from>2<currency_to>
+    - Pandas dataframe to Parquet file in S3 bucket (`PIPELINE_LOAD_MODE` = `s3` only)
+        - Uploads every worksheet to single Parquet file on AWS S3 bucket (env. variables)
     - Loads data into Redshift
-        TODO: We want to get rid of "staging" notion
-        - Truncates {PIPELINE_AWS_REDSHIFT_TABLE}_stage table
-        - Runs COPY ... CSV .. job to load data into {PIPELINE_AWS_REDSHIFT_TABLE}_stage table
+        - Creates temporary stage table like {PIPELINE_AWS_REDSHIFT_TABLE}
+        - Runs COPY ... FORMAT AS PARQUET job (or COPY ... FROM STDIN for `stdin`) to load data into the stage table
         - Upserts missing data into {PIPELINE_AWS_REDSHIFT_TABLE} by [date, currency_from, currency_to] attributes, when comparing with staging
     """
 
@@ -242,11 +423,16 @@ def pipeline():
         force=True
     )
 
+    if PIPELINE_LOAD_MODE not in ('s3', 'stdin'):
+        log.error(f'Unknown load mode "{PIPELINE_LOAD_MODE}"!')
+        exit(1)
+
     # Check if mandatory envs are found
     try:
-        PIPELINE_AWS_S3_URI = environ['PIPELINE_AWS_S3_URI']
-        PIPELINE_AWS_ACCESS_KEY_ID = environ['PIPELINE_AWS_ACCESS_KEY_ID']
-        PIPELINE_AWS_SECRET_ACCESS_KEY = environ['PIPELINE_AWS_SECRET_ACCESS_KEY']
+        if PIPELINE_LOAD_MODE == 's3':
+            PIPELINE_AWS_S3_URI = environ['PIPELINE_AWS_S3_URI']
+            PIPELINE_AWS_ACCESS_KEY_ID = environ['PIPELINE_AWS_ACCESS_KEY_ID']
+            PIPELINE_AWS_SECRET_ACCESS_KEY = environ['PIPELINE_AWS_SECRET_ACCESS_KEY']
 
         PIPELINE_AWS_REDSHIFT_DSN = environ['PIPELINE_AWS_REDSHIFT_DSN']
         PIPELINE_AWS_REDSHIFT_TABLE = environ['PIPELINE_AWS_REDSHIFT_TABLE']
@@ -257,31 +443,45 @@ def pipeline():
         log.exception('Missing environmental variable!')
         exit(1)
 
-    pl_start = datetime.now()
+    pl_start = monotonic()
     log.info(f'Pipeline "{PIPELINE_NAME}" started as standalone')
     try:
 
         # 1. Get data from google sheets
-        google_sheet_to_s3(
+        df = google_sheet_to_df(
             google_sheet_id=PIPELINE_GOOGLE_SHEET_ID,
-            google_service_account_credentials=literal_eval(PIPELINE_GOOGLE_SERVICE_ACCOUNT),
-            s3_uri=PIPELINE_AWS_S3_URI,
-            s3_key=PIPELINE_AWS_ACCESS_KEY_ID,
-            s3_secret=PIPELINE_AWS_SECRET_ACCESS_KEY
+            google_service_account_credentials=load_service_account(PIPELINE_GOOGLE_SERVICE_ACCOUNT)
         )
 
-        # 2. Load CSV into AWS Redshift from S3
-        load_csv_into_redshift(
-            redshift_dsn=PIPELINE_AWS_REDSHIFT_DSN,
-            redshift_table=PIPELINE_AWS_REDSHIFT_TABLE,
-            s3_uri=PIPELINE_AWS_S3_URI,
-            s3_key=PIPELINE_AWS_ACCESS_KEY_ID,
-            s3_secret=PIPELINE_AWS_SECRET_ACCESS_KEY
-        )
+        if df.empty:
+            log.warning('No data read from google sheet, skipping the load')
+        elif PIPELINE_LOAD_MODE == 'stdin':
+            # 2. Load the data straight into the database, skipping S3
+            load_into_redshift(
+                redshift_dsn=PIPELINE_AWS_REDSHIFT_DSN,
+                redshift_table=PIPELINE_AWS_REDSHIFT_TABLE,
+                df=df
+            )
+        else:
+            # 2. Stream the data to Parquet file in S3
+            stream_dataframe_to_s3(
+                df=df,
+                s3_uri=PIPELINE_AWS_S3_URI + S3_FILENAME,
+                s3_client=get_s3_client(PIPELINE_AWS_ACCESS_KEY_ID, PIPELINE_AWS_SECRET_ACCESS_KEY)
+            )
+
+            # 3. Load Parquet file into AWS Redshift from S3
+            load_into_redshift(
+                redshift_dsn=PIPELINE_AWS_REDSHIFT_DSN,
+                redshift_table=PIPELINE_AWS_REDSHIFT_TABLE,
+                s3_uri=PIPELINE_AWS_S3_URI + S3_FILENAME,
+                s3_key=PIPELINE_AWS_ACCESS_KEY_ID,
+                s3_secret=PIPELINE_AWS_SECRET_ACCESS_KEY
+            )
 
-        log.info(f'Pipeline finished successfully. Time taken {datetime.now() - pl_start}')
+        log.info(f'Pipeline finished successfully. Time taken {monotonic() - pl_start:.3f} seconds')
     except Exception as e:
-        log.exception(f'Unhandled error occured. Time taken {datetime.now() - pl_start}')
+        log.exception(f'Unhandled error occured. Time taken {monotonic() - pl_start:.3f} seconds')
 
 
 # For AWS Lambda only